@@ -1,187 +1,919 @@
+from langchain_core.documents import Document
+from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import RunnableParallel
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import sys
+import tempfile
+import time
 import uuid
-from langchain_google_genai import ChatGoogleGenerativeAI
+from langchain_google_genai import ChatGoogleGenerativeAI, GoogleGenerativeAIEmbeddings
+from pydantic import BaseModel, Field
+
+try:
+    import faiss
+    import numpy as np
+except ImportError:
+    faiss = None
+    np = None
+
+try:
+    import openai
+except ImportError:
+    openai = None
+
+_FIND_CHUNK_SYSTEM_PROMPT = """You are analyzing whether a new proposition belongs to an existing chunk based on semantic similarity and topical relevance.
+
+Your task:
+1. Compare the new proposition with each existing chunk's title and summary
+2. Determine if the proposition is semantically related or topically similar to any chunk
+3. Return ONLY the chunk ID if there's a good match, or return "NONE" if no match exists
+
+Guidelines:
+- Look for thematic connections, not just exact keyword matches
+- Consider if the proposition would logically belong with the existing content
+- If unsure, err on the side of creating a new chunk (return "NONE")
+
+Response format: Return only the chunk ID (e.g., "d41a2") or "NONE\""""
+
+
+class RouteDecision(BaseModel):
+    """Schema-constrained routing verdict: an existing chunk id or NONE."""
+
+    chunk_id: str = Field(pattern=r"^(NONE|[0-9a-f]{5})$")
+
+
+class DiskCache:
+    """sqlite-backed cache so restarts don't re-embed or re-ask the LLM.
+
+    Rows are keyed by sha256(model_id | content). Embeddings are stored as
+    raw float32 bytes, LLM responses as UTF-8 text. The model_version
+    column is written alongside so a model swap can migrate gradually
+    instead of invalidating every row at once.
+    """
+
+    def __init__(self, path="agentic_chunker_cache.db", model_version="1"):
+        self.model_version = model_version
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "hash TEXT PRIMARY KEY, model TEXT, model_version TEXT, value BLOB)"
+        )
+        self._conn.commit()
+
+    @staticmethod
+    def _key(model_id, content):
+        return hashlib.sha256(f"{model_id}|{content}".encode()).hexdigest()
+
+    def _get(self, model_id, content):
+        row = self._conn.execute(
+            "SELECT value FROM cache WHERE hash = ?", (self._key(model_id, content),)
+        ).fetchone()
+        return row[0] if row else None
+
+    def _put(self, model_id, content, value):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO cache (hash, model, model_version, value) VALUES (?, ?, ?, ?)",
+            (self._key(model_id, content), model_id, self.model_version, value),
+        )
+        self._conn.commit()
+
+    def get_text(self, model_id, prompt):
+        value = self._get(model_id, prompt)
+        return value.decode() if value is not None else None
+
+    def put_text(self, model_id, prompt, response):
+        self._put(model_id, prompt, response.encode())
+
+    def get_vector(self, model_id, text):
+        value = self._get(model_id, text)
+        if value is None:
+            return None
+        return np.frombuffer(value, dtype=np.float32).reshape(1, -1).copy()
+
+    def put_vector(self, model_id, text, vec):
+        self._put(model_id, text, np.asarray(vec, dtype=np.float32).tobytes())
+
+
+class SemanticCache:
+    """LRU + TTL cache for LLM responses, keyed by prompt embedding.
+
+    Exact-match hits are served from a hash dict; otherwise the prompt is
+    embedded and matched against cached prompts by cosine similarity
+    (faiss IndexFlatIP over L2-normalized vectors). Without an embedder
+    the cache degrades to exact-match only.
+    """
+
+    def __init__(self, embeddings=None, maxsize=256, ttl=300.0, similarity_threshold=0.87):
+        self.embeddings = embeddings if faiss is not None else None
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self._entries = []  # [{'hash', 'vec', 'response', 'last_access'}], index rows parallel to this
+        self._by_hash = {}
+        self._index = None
+
+    @staticmethod
+    def _hash(prompt):
+        return hashlib.sha256(prompt.encode()).hexdigest()
+
+    def _embed(self, prompt):
+        vec = np.asarray(self.embeddings.embed_query(prompt), dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vec)
+        return vec
+
+    def _touch(self, entry):
+        entry['last_access'] = time.monotonic()
+        return entry['response']
+
+    def _expired(self, entry):
+        return time.monotonic() - entry['last_access'] > self.ttl
+
+    def get(self, prompt):
+        # Exact-match fast path
+        entry = self._by_hash.get(self._hash(prompt))
+        if entry is not None and not self._expired(entry):
+            return self._touch(entry)
+
+        if self.embeddings is None or self._index is None or self._index.ntotal == 0:
+            return None
+
+        D, I = self._index.search(self._embed(prompt), 1)
+        if D[0, 0] >= self.similarity_threshold:
+            entry = self._entries[I[0, 0]]
+            if not self._expired(entry):
+                return self._touch(entry)
+        return None
+
+    def put(self, prompt, response):
+        vec = self._embed(prompt) if self.embeddings is not None else None
+        entry = {
+            'hash': self._hash(prompt),
+            'vec': vec,
+            'response': response,
+            'last_access': time.monotonic(),
+        }
+        self._entries.append(entry)
+        self._by_hash[entry['hash']] = entry
+
+        # Drop expired entries, then least-recently-used until within maxsize
+        live = [e for e in self._entries if not self._expired(e)]
+        if len(live) > self.maxsize:
+            live.sort(key=lambda e: e['last_access'])
+            live = live[len(live) - self.maxsize:]
+        if len(live) != len(self._entries):
+            self._entries = live
+            self._by_hash = {e['hash']: e for e in live}
+            self._index = None  # force rebuild below
+
+        if vec is not None:
+            if self._index is None:
+                self._index = faiss.IndexFlatIP(vec.shape[1])
+                vecs = [e['vec'] for e in self._entries if e['vec'] is not None]
+                if vecs:
+                    self._index.add(np.vstack(vecs))
+            else:
+                self._index.add(vec)
 
 class AgenticChunker:
-    def __init__(self):
-        self.chunks = {}
+    def __init__(self, use_semantic_routing=True, routing_index='flat', disk_cache_path="agentic_chunker_cache.db",
+                 batch_mode=False, batch_model="gpt-4o-mini", batch_base_url=None):
+        # Chunk storage is structure-of-arrays: parallel lists indexed by row,
+        # with id_to_row mapping chunk ids to rows. The chunks property offers
+        # a backward-compatible dict-of-dicts view.
+        self.ids = []
+        self.titles = []
+        self.summaries = []
+        self.propositions = []  # one list of propositions per row
+        self.id_to_row = {}
+        self._joined = []
+
         self.id_truncate_limit = 5
+        self._chunk_id_set = set()
+        self._id_re = re.compile(r"[0-9a-f]{%d}" % self.id_truncate_limit)
         self.generate_new_metadata_ind = True
         self.print_logging = True
 
-        self.llm = ChatGoogleGenerativeAI(model="models/gemini-1.5-flash")
+        # logging defers %-formatting until a handler actually emits, so
+        # disabled levels cost nothing on the hot path
+        self.log = logging.getLogger(__name__)
+        if self.print_logging and not logging.getLogger().handlers:
+            logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+        self.log.setLevel(logging.DEBUG if self.print_logging else logging.WARNING)
+
+        # Routing only ever emits a 5-char id or NONE, so it runs on the
+        # smallest/cheapest model with a hard output cap; metadata generation
+        # (summaries, titles) keeps the larger flash model.
+        self.llm_router = ChatGoogleGenerativeAI(model="models/gemini-1.5-flash-8b", max_output_tokens=8, temperature=0)
+        self.llm_router_batch = ChatGoogleGenerativeAI(model="models/gemini-1.5-flash-8b", max_output_tokens=512, temperature=0)
+        self.llm_meta = ChatGoogleGenerativeAI(model="models/gemini-1.5-flash", max_output_tokens=64, temperature=0.2)
+        self.llm = self.llm_meta  # kept for callers that poke at .llm directly
+
+        # Prompt pipelines are built once; each call is then a plain invoke
+        # instead of re-compiling the template on the hot path.
+        self._r_update_summary = self._build_update_summary_runnable()
+        self._r_update_title = self._build_update_title_runnable()
+        self._r_new_summary = self._build_new_summary_runnable()
+        self._r_new_title = self._build_new_title_runnable()
+        self._r_find = self._build_find_chunk_runnable()
+        self._r_find_batch = self._build_find_chunks_batch_runnable()
+
+        # Embedding-based routing: nearest chunk by cosine similarity over
+        # summary/title embeddings instead of an LLM call per proposition.
+        # Falls back to the LLM judge when faiss/numpy are not installed.
+        self.use_semantic_routing = use_semantic_routing and faiss is not None
+        self.routing_similarity_threshold = 0.40
+        self.embeddings = GoogleGenerativeAIEmbeddings(model="models/embedding-001") if self.use_semantic_routing else None
+        # 'flat' scans every chunk vector exactly; 'lsh' hashes into buckets so
+        # lookups stay sub-linear at tens of thousands of chunks, with the
+        # top-1 candidate re-checked by exact cosine before acceptance.
+        self.routing_index_kind = routing_index
+        self.lsh_nbits = 256
+        self.index = None  # built lazily once the embedding dimension is known
+        self.chunk_ids_by_row = []
+        self._chunk_vecs = []
+        self.cache_stats = {"hits": 0, "misses": 0}
+
+        # Offline ingest: route the first-pass classification through an
+        # OpenAI-compatible Batch API (half the per-token price, latency
+        # acceptable for bulk indexing). Requires the openai package; falls
+        # back to the online Gemini path otherwise.
+        self.batch_mode = batch_mode and openai is not None
+        self.batch_model = batch_model
+        self.batch_base_url = batch_base_url
+        self.batch_poll_interval = 30
+
+        # Persist embeddings and LLM responses across process restarts;
+        # pass disk_cache_path=None for a purely in-memory run.
+        self.disk_cache = DiskCache(disk_cache_path) if disk_cache_path else None
+
+        # Near-identical chunk states show up repeatedly during iterative
+        # ingestion; serve those from cache instead of re-asking Gemini.
+        self.semantic_cache = SemanticCache(self.embeddings, maxsize=256, ttl=300.0, similarity_threshold=0.87)
+
+        # Buffer metadata regeneration: appending 20 propositions to one chunk
+        # should not mean 40 LLM calls. Regenerate every _regen_every appends
+        # per chunk, and on flush().
+        self._dirty_chunks = set()
+        self._dirty_counts = {}
+        self._regen_every = 5
+
+        # Incrementally-maintained outline: one pre-rendered block per chunk,
+        # joined lazily instead of re-concatenated on every routing call. The
+        # routing prompt is additionally capped to the most recently touched
+        # chunks to bound prompt tokens.
+        self._outline_parts = {}  # chunk_id -> rendered block, in recency order
+        self._outline_cache = ""
+        self._outline_routing_cache = ""
+        self._outline_dirty = False
+        self.outline_max_chunks = 50
+
+    @property
+    def chunks(self):
+        # Materialized dict-of-dicts view for callers that expect the old
+        # layout; mutate through the API, not through this view
+        return {
+            chunk_id: {
+                'chunk_id': chunk_id,
+                'propositions': self.propositions[row],
+                'title': self.titles[row],
+                'summary': self.summaries[row],
+                'chunk_index': row
+            }
+            for chunk_id, row in self.id_to_row.items()
+        }
 
     def add_propositions(self, propositions):
-        for proposition in propositions:
-            self.add_proposition(proposition)
-    
+        propositions = list(propositions)
+        if not propositions:
+            return
+
+        # Bootstrap the first chunk so there is an outline to route against
+        start = 0
+        if len(self.ids) == 0:
+            self._create_new_chunk(propositions[0])
+            start = 1
+
+        remaining = propositions[start:]
+        if remaining:
+            # First pass: classify the whole batch against the frozen outline in
+            # one LLM call, amortizing the outline prefix across propositions.
+            if self.batch_mode:
+                first_pass = self._find_relevant_chunks_offline_batch(remaining)
+            else:
+                first_pass = self._find_relevant_chunks_batch(remaining)
+            for proposition, chunk_id in zip(remaining, first_pass):
+                if chunk_id and chunk_id in self.id_to_row:
+                    self.log.debug("Chunk Found (%s), adding to: %s", chunk_id, self.titles[self.id_to_row[chunk_id]])
+                    self.add_proposition_to_chunk(chunk_id, proposition)
+                else:
+                    # May belong to a chunk created earlier in this same loop;
+                    # re-route against the live outline.
+                    self.add_proposition(proposition)
+
+        self.flush()
+
+    async def aadd_propositions(self, propositions, concurrency_limit=5):
+        propositions = list(propositions)
+        if not propositions:
+            return
+
+        # Bootstrap the first chunk sequentially so there is an outline to route against
+        start = 0
+        if len(self.ids) == 0:
+            await self._acreate_new_chunk(propositions[0])
+            start = 1
+
+        remaining = propositions[start:]
+        if not remaining:
+            return
+
+        # First pass: classify every proposition against the frozen outline concurrently
+        semaphore = asyncio.Semaphore(concurrency_limit)
+
+        async def classify(proposition):
+            async with semaphore:
+                return await self._afind_relevant_chunk(proposition)
+
+        first_pass = await asyncio.gather(*[classify(p) for p in remaining])
+
+        # Second pass: apply results in order. Matches against the frozen outline are
+        # safe to use directly; unmatched propositions fall back to the sequential path
+        # because they may belong to a chunk created earlier in this same loop.
+        for proposition, chunk_id in zip(remaining, first_pass):
+            if chunk_id and chunk_id in self.id_to_row:
+                self.log.debug("Chunk Found (%s), adding to: %s", chunk_id, self.titles[self.id_to_row[chunk_id]])
+                await self.aadd_proposition_to_chunk(chunk_id, proposition)
+            else:
+                await self.aadd_proposition(proposition)
+
+        await self.aflush()
+
+    async def aadd_proposition(self, proposition):
+        self.log.debug("\nAdding: '%s'", proposition)
+
+        if len(self.ids) == 0:
+            self.log.debug("No chunks, creating a new one")
+            await self._acreate_new_chunk(proposition)
+            return
+
+        chunk_id = await self._afind_relevant_chunk(proposition)
+
+        if chunk_id:
+            self.log.debug("Chunk Found (%s), adding to: %s", chunk_id, self.titles[self.id_to_row[chunk_id]])
+            await self.aadd_proposition_to_chunk(chunk_id, proposition)
+        else:
+            self.log.debug("No chunks found")
+            await self._acreate_new_chunk(proposition)
+
+    async def aadd_proposition_to_chunk(self, chunk_id, proposition):
+        row = self.id_to_row[chunk_id]
+        self.propositions[row].append(proposition)
+        self._joined[row] = None
+
+        if self.generate_new_metadata_ind and self._mark_dirty(chunk_id):
+            await self._aregenerate_chunk_metadata(chunk_id)
+
     def add_proposition(self, proposition):
-        if self.print_logging:
-            print(f"\nAdding: '{proposition}'")
+        self.log.debug("\nAdding: '%s'", proposition)
 
-        if len(self.chunks) == 0:
-            if self.print_logging:
-                print("No chunks, creating a new one")
+        if len(self.ids) == 0:
+            self.log.debug("No chunks, creating a new one")
             self._create_new_chunk(proposition)
             return
 
         chunk_id = self._find_relevant_chunk(proposition)
 
         if chunk_id:
-            if self.print_logging:
-                print(f"Chunk Found ({chunk_id}), adding to: {self.chunks[chunk_id]['title']}")
+            self.log.debug("Chunk Found (%s), adding to: %s", chunk_id, self.titles[self.id_to_row[chunk_id]])
             self.add_proposition_to_chunk(chunk_id, proposition)
         else:
-            if self.print_logging:
-                print("No chunks found")
+            self.log.debug("No chunks found")
             self._create_new_chunk(proposition)
     
     def add_proposition_to_chunk(self, chunk_id, proposition):
-        self.chunks[chunk_id]['propositions'].append(proposition)
+        row = self.id_to_row[chunk_id]
+        self.propositions[row].append(proposition)
+        self._joined[row] = None
+
+        if self.generate_new_metadata_ind and self._mark_dirty(chunk_id):
+            self._regenerate_chunk_metadata(chunk_id)
+
+    def _mark_dirty(self, chunk_id):
+        self._render_outline_part(chunk_id)  # refresh recency even if text is unchanged
+        self._dirty_chunks.add(chunk_id)
+        self._dirty_counts[chunk_id] = self._dirty_counts.get(chunk_id, 0) + 1
+        return self._dirty_counts[chunk_id] >= self._regen_every
+
+    def _regenerate_chunk_metadata(self, chunk_id):
+        # Both prompts take the pre-update summary/title, so the two calls are
+        # independent and can share one round trip instead of running serially.
+        # The new title is based on the pre-update summary as a result.
+        row = self.id_to_row[chunk_id]
+        summary_inputs = self._update_summary_inputs(row)
+        title_inputs = self._update_title_inputs(row)
+        summary_key = self._cache_key("update_summary", summary_inputs)
+        title_key = self._cache_key("update_title", title_inputs)
+
+        summary = self._cache_lookup(summary_key, "update_summary")
+        title = self._cache_lookup(title_key, "update_title")
+        if summary is None and title is None:
+            results = RunnableParallel(
+                summary=self._r_update_summary,
+                title=self._r_update_title
+            ).invoke({**summary_inputs, **title_inputs})
+            summary = results['summary'].strip()
+            title = results['title'].strip()
+            self._cache_store(summary_key, "update_summary", summary)
+            self._cache_store(title_key, "update_title", title)
+        elif summary is None:
+            summary = self._invoke_cached(self._r_update_summary, summary_inputs, "update_summary")
+        elif title is None:
+            title = self._invoke_cached(self._r_update_title, title_inputs, "update_title")
+
+        self._apply_chunk_metadata(chunk_id, summary, title)
+
+    async def _aregenerate_chunk_metadata(self, chunk_id):
+        row = self.id_to_row[chunk_id]
+        summary_inputs = self._update_summary_inputs(row)
+        title_inputs = self._update_title_inputs(row)
+        summary_key = self._cache_key("update_summary", summary_inputs)
+        title_key = self._cache_key("update_title", title_inputs)
+
+        summary = self._cache_lookup(summary_key, "update_summary")
+        title = self._cache_lookup(title_key, "update_title")
+        if summary is None and title is None:
+            summary, title = await asyncio.gather(
+                self._r_update_summary.ainvoke(summary_inputs),
+                self._r_update_title.ainvoke(title_inputs)
+            )
+            summary = summary.strip()
+            title = title.strip()
+            self._cache_store(summary_key, "update_summary", summary)
+            self._cache_store(title_key, "update_title", title)
+        elif summary is None:
+            summary = await self._ainvoke_cached(self._r_update_summary, summary_inputs, "update_summary")
+        elif title is None:
+            title = await self._ainvoke_cached(self._r_update_title, title_inputs, "update_title")
+
+        self._apply_chunk_metadata(chunk_id, summary, title)
+
+    def _apply_chunk_metadata(self, chunk_id, summary, title):
+        row = self.id_to_row[chunk_id]
+        self.summaries[row] = summary
+        self.titles[row] = title
+        self._render_outline_part(chunk_id)
+        self._reindex_chunk(chunk_id)
+        self._dirty_chunks.discard(chunk_id)
+        self._dirty_counts[chunk_id] = 0
+
+    def flush(self):
+        for chunk_id in list(self._dirty_chunks):
+            self._regenerate_chunk_metadata(chunk_id)
+
+    async def aflush(self):
+        for chunk_id in list(self._dirty_chunks):
+            await self._aregenerate_chunk_metadata(chunk_id)
+
+    @staticmethod
+    def _cache_key(name, inputs):
+        return name + "\n" + "\n".join(f"{k}: {inputs[k]}" for k in sorted(inputs))
+
+    def _llm_model_id(self, cache_name):
+        llm = self.llm_router if cache_name.startswith("find") else self.llm_meta
+        return llm.model
+
+    def _cache_lookup(self, key, cache_name):
+        cached = self.semantic_cache.get(key)
+        if cached is not None:
+            return cached
+        if self.disk_cache is not None:
+            stored = self.disk_cache.get_text(self._llm_model_id(cache_name), key)
+            if stored is not None:
+                self.semantic_cache.put(key, stored)
+                return stored
+        return None
+
+    def _cache_store(self, key, cache_name, result):
+        self.semantic_cache.put(key, result)
+        if self.disk_cache is not None:
+            self.disk_cache.put_text(self._llm_model_id(cache_name), key, result)
+
+    def _invoke_cached(self, runnable, inputs, cache_name):
+        key = self._cache_key(cache_name, inputs)
+        cached = self._cache_lookup(key, cache_name)
+        if cached is not None:
+            return cached
+        result = runnable.invoke(inputs).strip()
+        self._cache_store(key, cache_name, result)
+        return result
 
-        if self.generate_new_metadata_ind:
-            self.chunks[chunk_id]['summary'] = self._update_chunk_summary(self.chunks[chunk_id])
-            self.chunks[chunk_id]['title'] = self._update_chunk_title(self.chunks[chunk_id])
+    async def _ainvoke_cached(self, runnable, inputs, cache_name):
+        key = self._cache_key(cache_name, inputs)
+        cached = self._cache_lookup(key, cache_name)
+        if cached is not None:
+            return cached
+        result = (await runnable.ainvoke(inputs)).strip()
+        self._cache_store(key, cache_name, result)
+        return result
 
-    def _update_chunk_summary(self, chunk):
+    def _build_update_summary_runnable(self):
         PROMPT = ChatPromptTemplate.from_messages([
             ("system", """You are grouping similar sentences. Generate a 1-sentence summary that generalizes the topic of all given propositions. Be concise and clear."""),
             ("user", "Propositions:\n{proposition}\n\nCurrent summary:\n{current_summary}")
         ])
-        runnable = PROMPT | self.llm
+        return PROMPT | self.llm_meta | StrOutputParser()
 
-        result = runnable.invoke({
-            "proposition": "\n".join(chunk['propositions']),
-            "current_summary": chunk['summary']
-        }).content.strip()
+    def _update_chunk_summary(self, chunk_id):
+        inputs = self._update_summary_inputs(self.id_to_row[chunk_id])
+        return self._invoke_cached(self._r_update_summary, inputs, "update_summary")
 
-        return result
+    async def _aupdate_chunk_summary(self, chunk_id):
+        inputs = self._update_summary_inputs(self.id_to_row[chunk_id])
+        return await self._ainvoke_cached(self._r_update_summary, inputs, "update_summary")
+
+    def _update_summary_inputs(self, row):
+        return {
+            "proposition": "\n".join(self.propositions[row]),
+            "current_summary": self.summaries[row]
+        }
 
-    def _update_chunk_title(self, chunk):
+    def _build_update_title_runnable(self):
         PROMPT = ChatPromptTemplate.from_messages([
             ("system", """You are generating titles for groups of related sentences. Given the summary and propositions, generate a concise and generalized title (e.g., 'Food Preferences', 'Dates & Time')."""),
             ("user", "Propositions:\n{proposition}\n\nSummary:\n{current_summary}\n\nCurrent title:\n{current_title}")
         ])
-        runnable = PROMPT | self.llm
+        return PROMPT | self.llm_meta | StrOutputParser()
 
-        result = runnable.invoke({
-            "proposition": "\n".join(chunk['propositions']),
-            "current_summary": chunk['summary'],
-            "current_title": chunk['title']
-        }).content.strip()
+    def _update_chunk_title(self, chunk_id):
+        inputs = self._update_title_inputs(self.id_to_row[chunk_id])
+        return self._invoke_cached(self._r_update_title, inputs, "update_title")
 
-        return result
+    async def _aupdate_chunk_title(self, chunk_id):
+        inputs = self._update_title_inputs(self.id_to_row[chunk_id])
+        return await self._ainvoke_cached(self._r_update_title, inputs, "update_title")
 
-    def _get_new_chunk_summary(self, proposition):
+    def _update_title_inputs(self, row):
+        return {
+            "proposition": "\n".join(self.propositions[row]),
+            "current_summary": self.summaries[row],
+            "current_title": self.titles[row]
+        }
+
+    def _build_new_summary_runnable(self):
         PROMPT = ChatPromptTemplate.from_messages([
             ("system", """Summarize the following proposition into a 1-sentence general summary suitable for grouping similar statements."""),
             ("user", "Proposition:\n{proposition}")
         ])
-        runnable = PROMPT | self.llm
-        result = runnable.invoke({"proposition": proposition}).content.strip()
-        return result
+        return PROMPT | self.llm_meta | StrOutputParser()
 
-    def _get_new_chunk_title(self, summary):
+    def _get_new_chunk_summary(self, proposition):
+        return self._invoke_cached(self._r_new_summary, {"proposition": proposition}, "new_summary")
+
+    async def _aget_new_chunk_summary(self, proposition):
+        return await self._ainvoke_cached(self._r_new_summary, {"proposition": proposition}, "new_summary")
+
+    def _build_new_title_runnable(self):
         PROMPT = ChatPromptTemplate.from_messages([
             ("system", """Generate a short and generalized title based on the summary below (e.g., 'Dates & Time', 'Food Preferences')."""),
             ("user", "Summary:\n{summary}")
         ])
-        runnable = PROMPT | self.llm
-        result = runnable.invoke({"summary": summary}).content.strip()
-        return result
+        return PROMPT | self.llm_meta | StrOutputParser()
+
+    def _get_new_chunk_title(self, summary):
+        return self._invoke_cached(self._r_new_title, {"summary": summary}, "new_title")
+
+    async def _aget_new_chunk_title(self, summary):
+        return await self._ainvoke_cached(self._r_new_title, {"summary": summary}, "new_title")
 
     def _create_new_chunk(self, proposition):
-        new_chunk_id = str(uuid.uuid4())[:self.id_truncate_limit]
         new_chunk_summary = self._get_new_chunk_summary(proposition)
         new_chunk_title = self._get_new_chunk_title(new_chunk_summary)
+        self._register_new_chunk(proposition, new_chunk_title, new_chunk_summary)
+
+    async def _acreate_new_chunk(self, proposition):
+        new_chunk_summary = await self._aget_new_chunk_summary(proposition)
+        new_chunk_title = await self._aget_new_chunk_title(new_chunk_summary)
+        self._register_new_chunk(proposition, new_chunk_title, new_chunk_summary)
+
+    def _register_new_chunk(self, proposition, new_chunk_title, new_chunk_summary):
+        # Truncated ids only carry ~20 bits, so collisions become likely around
+        # a thousand chunks; retry rather than silently overwriting a chunk
+        new_chunk_id = uuid.uuid4().hex[:self.id_truncate_limit]
+        while new_chunk_id in self.id_to_row:
+            new_chunk_id = uuid.uuid4().hex[:self.id_truncate_limit]
+
+        self._chunk_id_set.add(new_chunk_id)
+        self.id_to_row[new_chunk_id] = len(self.ids)
+        self.ids.append(new_chunk_id)
+        self.titles.append(new_chunk_title)
+        self.summaries.append(new_chunk_summary)
+        self.propositions.append([proposition])
+        self._joined.append(None)
+
+        self.log.debug("Created new chunk (%s): %s", new_chunk_id, new_chunk_title)
+
+        self._render_outline_part(new_chunk_id)
+        self._index_chunk(new_chunk_id)
+
+    def _embed(self, text):
+        if self.disk_cache is not None:
+            cached = self.disk_cache.get_vector(self.embeddings.model, text)
+            if cached is not None:
+                return cached
+        vec = np.asarray(self.embeddings.embed_query(text), dtype=np.float32).reshape(1, -1)
+        faiss.normalize_L2(vec)
+        if self.disk_cache is not None:
+            self.disk_cache.put_vector(self.embeddings.model, text, vec)
+        return vec
+
+    def _chunk_embedding_text(self, row):
+        return f"{self.titles[row]}. {self.summaries[row]}"
+
+    def _index_chunk(self, chunk_id):
+        if not self.use_semantic_routing:
+            return
+        vec = self._embed(self._chunk_embedding_text(self.id_to_row[chunk_id]))
+        if self.index is None:
+            self.index = self._new_routing_index(vec.shape[1])
+        self.index.add(vec)
+        self.chunk_ids_by_row.append(chunk_id)
+        self._chunk_vecs.append(vec)
+
+    def _reindex_chunk(self, chunk_id):
+        # Title/summary changed, so the stored embedding is stale. IndexFlatIP has
+        # no in-place update, so replace the row's vector and rebuild.
+        if not self.use_semantic_routing or chunk_id not in self.chunk_ids_by_row:
+            return
+        row = self.chunk_ids_by_row.index(chunk_id)
+        self._chunk_vecs[row] = self._embed(self._chunk_embedding_text(self.id_to_row[chunk_id]))
+        self.index = self._new_routing_index(self._chunk_vecs[0].shape[1])
+        self.index.add(np.vstack(self._chunk_vecs))
+
+    def _new_routing_index(self, d):
+        if self.routing_index_kind == 'lsh':
+            return faiss.IndexLSH(d, self.lsh_nbits)
+        return faiss.IndexFlatIP(d)
+
+    def _semantic_route(self, proposition):
+        query = self._embed(proposition)
+        D, I = self.index.search(query, 1)
+        row = int(I[0, 0])
+        if row < 0:
+            self.cache_stats["misses"] += 1
+            return None
+        # Confirm by exact cosine against the stored vector: the LSH index
+        # returns Hamming distances, not similarities.
+        similarity = float(query @ self._chunk_vecs[row].T)
+        self.log.debug("Nearest chunk similarity: %.3f", similarity)
+        if similarity >= self.routing_similarity_threshold:
+            self.cache_stats["hits"] += 1
+            return self.chunk_ids_by_row[row]
+        self.cache_stats["misses"] += 1
+        return None
 
-        self.chunks[new_chunk_id] = {
-            'chunk_id': new_chunk_id,
-            'propositions': [proposition],
-            'title': new_chunk_title,
-            'summary': new_chunk_summary,
-            'chunk_index': len(self.chunks)
-        }
-
-        if self.print_logging:
-            print(f"Created new chunk ({new_chunk_id}): {new_chunk_title}")
-
-    def _find_relevant_chunk(self, proposition):
-        current_chunk_outline = self.get_chunk_outline()
-
+    def _build_find_chunk_runnable(self):
         PROMPT = ChatPromptTemplate.from_messages([
-            ("system", """You are analyzing whether a new proposition belongs to an existing chunk based on semantic similarity and topical relevance.
+            ("system", _FIND_CHUNK_SYSTEM_PROMPT),
+            ("user", "Existing Chunks:\n{current_chunk_outline}\n\nNew Proposition: {proposition}")
+        ])
+        # Structured output pins the reply to {"chunk_id": "NONE" | "<5-char-hex>"},
+        # so there is no free-form text to post-parse
+        return PROMPT | self.llm_router.with_structured_output(RouteDecision)
 
-Your task:
-1. Compare the new proposition with each existing chunk's title and summary
-2. Determine if the proposition is semantically related or topically similar to any chunk
-3. Return ONLY the chunk ID if there's a good match, or return "NONE" if no match exists
+    def _build_find_chunks_batch_runnable(self):
+        PROMPT = ChatPromptTemplate.from_messages([
+            ("system", """You are assigning new propositions to existing chunks based on semantic similarity and topical relevance.
 
-Guidelines:
-- Look for thematic connections, not just exact keyword matches
-- Consider if the proposition would logically belong with the existing content
-- If unsure, err on the side of creating a new chunk (return "NONE")
+For each numbered proposition, compare it against each existing chunk's title and summary.
 
-Response format: Return only the chunk ID (e.g., "d41a2") or "NONE"""
+Response format: output exactly one line per proposition, in order, of the form:
+<number>. <chunk ID>
+using a chunk ID from the outline if there's a good match, or:
+<number>. NONE
+if no chunk matches. Output nothing else. If unsure, err on the side of NONE."""
             ),
-            ("user", "Existing Chunks:\n{current_chunk_outline}\n\nNew Proposition: {proposition}")
+            ("user", "Existing Chunks:\n{current_chunk_outline}\n\nPropositions:\n{numbered_propositions}")
         ])
+        return PROMPT | self.llm_router_batch | StrOutputParser()
+
+    def _find_relevant_chunks_batch(self, propositions):
+        if self.use_semantic_routing and self.index is not None:
+            return [self._semantic_route(p) for p in propositions]
+        if len(self.ids) == 0:
+            return [None] * len(propositions)
+
+        numbered = "\n".join(f"{i + 1}. {p}" for i, p in enumerate(propositions))
+        result = self._invoke_cached(self._r_find_batch, {
+            "current_chunk_outline": self._get_routing_outline(),
+            "numbered_propositions": numbered
+        }, "find_chunks_batch")
+
+        self.log.debug("LLM Batch Response:\n%s", result)
+
+        answers = [None] * len(propositions)
+        for line in result.splitlines():
+            prefix, _, rest = line.strip().partition('.')
+            if not prefix.strip().isdigit():
+                continue
+            i = int(prefix.strip()) - 1
+            if 0 <= i < len(answers):
+                answers[i] = self._match_chunk_id(rest.strip().strip('"'))
+        return answers
+
+    def _find_relevant_chunks_offline_batch(self, propositions):
+        outline = self._get_routing_outline()
+        try:
+            client = openai.OpenAI(base_url=self.batch_base_url) if self.batch_base_url else openai.OpenAI()
+
+            with tempfile.NamedTemporaryFile("w", suffix=".jsonl", delete=False) as f:
+                for i, proposition in enumerate(propositions):
+                    f.write(json.dumps({
+                        "custom_id": str(i),
+                        "method": "POST",
+                        "url": "/v1/chat/completions",
+                        "body": {
+                            "model": self.batch_model,
+                            "temperature": 0,
+                            "max_tokens": 8,
+                            "messages": [
+                                {"role": "system", "content": _FIND_CHUNK_SYSTEM_PROMPT},
+                                {"role": "user", "content": f"Existing Chunks:\n{outline}\n\nNew Proposition: {proposition}"}
+                            ]
+                        }
+                    }) + "\n")
+                input_path = f.name
+
+            with open(input_path, "rb") as f:
+                input_file = client.files.create(file=f, purpose="batch")
+            batch = client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window="24h"
+            )
+            self.log.debug("Submitted routing batch %s (%d propositions)", batch.id, len(propositions))
+
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                time.sleep(self.batch_poll_interval)
+                batch = client.batches.retrieve(batch.id)
+
+            if batch.status != "completed":
+                raise RuntimeError(f"batch {batch.id} ended with status {batch.status}")
+
+            answers = [None] * len(propositions)
+            for line in client.files.content(batch.output_file_id).text.splitlines():
+                obj = json.loads(line)
+                i = int(obj["custom_id"])
+                if 0 <= i < len(answers):
+                    reply = obj["response"]["body"]["choices"][0]["message"]["content"].strip()
+                    answers[i] = self._match_chunk_id(reply)
+            return answers
+        except Exception as exc:
+            self.log.debug("Batch routing failed (%s), falling back to online path", exc)
+            return self._find_relevant_chunks_batch(propositions)
+
+    def _find_relevant_chunk(self, proposition):
+        if self.use_semantic_routing and self.index is not None:
+            return self._semantic_route(proposition)
 
-        runnable = PROMPT | self.llm
-        result = runnable.invoke({
+        result = self._invoke_find({
             "proposition": proposition,
-            "current_chunk_outline": current_chunk_outline
-        }).content.strip()
+            "current_chunk_outline": self._get_routing_outline()
+        })
+        return self._accept_route(result)
 
-        if self.print_logging:
-            print(f"LLM Response: '{result}'")
+    async def _afind_relevant_chunk(self, proposition):
+        if self.use_semantic_routing and self.index is not None:
+            return self._semantic_route(proposition)
 
+        result = await self._ainvoke_find({
+            "proposition": proposition,
+            "current_chunk_outline": self._get_routing_outline()
+        })
+        return self._accept_route(result)
+
+    def _invoke_find(self, inputs):
+        key = self._cache_key("find_chunk", inputs)
+        cached = self._cache_lookup(key, "find_chunk")
+        if cached is not None:
+            return cached
+        result = self._r_find.invoke(inputs).chunk_id
+        self._cache_store(key, "find_chunk", result)
+        return result
+
+    async def _ainvoke_find(self, inputs):
+        key = self._cache_key("find_chunk", inputs)
+        cached = self._cache_lookup(key, "find_chunk")
+        if cached is not None:
+            return cached
+        result = (await self._r_find.ainvoke(inputs)).chunk_id
+        self._cache_store(key, "find_chunk", result)
+        return result
+
+    def _accept_route(self, chunk_id):
+        self.log.debug("LLM Response: '%s'", chunk_id)
+        # The schema guarantees the shape; still require the id to exist, since
+        # the model can emit a well-formed id that matches no chunk
+        if chunk_id == "NONE" or chunk_id not in self._chunk_id_set:
+            return None
+        return chunk_id
+
+    def _match_chunk_id(self, result):
         # More robust checking for "no match" responses
         if result.upper() in ["NONE", "NO CHUNKS", "NO MATCH", "NO"]:
             return None
-        
+
         # Check if the result is a valid chunk ID
-        if result in self.chunks:
+        if result in self._chunk_id_set:
             return result
-        
+
         # Check if it's a truncated version of a valid chunk ID
-        if result[:self.id_truncate_limit] in self.chunks:
+        if result[:self.id_truncate_limit] in self._chunk_id_set:
             return result[:self.id_truncate_limit]
-        
-        # Try to find a chunk ID within the response (in case LLM adds extra text)
-        for chunk_id in self.chunks.keys():
-            if chunk_id in result:
-                return chunk_id
-        
+
+        # Extract a chunk ID from the response (in case the LLM adds extra text);
+        # regex + set membership stays O(len(result)) however many chunks exist
+        for candidate in self._id_re.findall(result):
+            if candidate in self._chunk_id_set:
+                return candidate
+
         return None
 
+    def _render_outline_part(self, chunk_id):
+        row = self.id_to_row[chunk_id]
+        # pop + reinsert moves the block to the end, keeping dict order = recency order
+        self._outline_parts.pop(chunk_id, None)
+        self._outline_parts[chunk_id] = f"Chunk ID: {chunk_id}\nChunk Name: {self.titles[row]}\nChunk Summary: {self.summaries[row]}\n\n"
+        self._outline_dirty = True
+
+    def _refresh_outline_caches(self):
+        if self._outline_dirty:
+            parts = list(self._outline_parts.values())
+            self._outline_cache = "".join(parts)
+            self._outline_routing_cache = "".join(parts[-self.outline_max_chunks:])
+            self._outline_dirty = False
+
     def get_chunk_outline(self):
-        outline = ""
-        for chunk in self.chunks.values():
-            outline += f"Chunk ID: {chunk['chunk_id']}\nChunk Name: {chunk['title']}\nChunk Summary: {chunk['summary']}\n\n"
-        return outline
+        self._refresh_outline_caches()
+        return self._outline_cache
+
+    def _get_routing_outline(self):
+        self._refresh_outline_caches()
+        return self._outline_routing_cache
+
+    def _joined_propositions(self, row):
+        # Joined once per chunk state; the append paths reset it to None
+        if self._joined[row] is None:
+            self._joined[row] = " ".join(self.propositions[row])
+        return self._joined[row]
 
     def get_chunks(self, get_type='dict'):
+        self.flush()
         if get_type == 'dict':
             return self.chunks
         if get_type == 'list_of_strings':
-            return [" ".join(chunk['propositions']) for chunk in self.chunks.values()]
+            return [self._joined_propositions(row) for row in range(len(self.ids))]
+        if get_type == 'batched_texts':
+            # One flat list, ready for a single embeddings.embed_documents(texts)
+            # call instead of one embedding request per chunk
+            return [self._joined_propositions(row) for row in range(len(self.ids))]
+        if get_type == 'documents':
+            return [
+                Document(
+                    page_content=self._joined_propositions(row),
+                    metadata={
+                        'chunk_id': chunk_id,
+                        'title': self.titles[row],
+                        'summary': self.summaries[row],
+                        'chunk_index': row
+                    }
+                )
+                for row, chunk_id in enumerate(self.ids)
+            ]
 
     def pretty_print_chunks(self):
-        print(f"\nYou have {len(self.chunks)} chunks\n")
-        for chunk in self.chunks.values():
-            print(f"Chunk #{chunk['chunk_index']}")
-            print(f"Chunk ID: {chunk['chunk_id']}")
-            print(f"Title: {chunk['title']}")
-            print(f"Summary: {chunk['summary']}")
-            print("Propositions:")
-            for prop in chunk['propositions']:
-                print(f"  - {prop}")
-            print("\n")
+        self.flush()
+        # Accumulate into a list and write once rather than one print per line
+        parts = [f"\nYou have {len(self.ids)} chunks\n\n"]
+        for row, chunk_id in enumerate(self.ids):
+            parts.append(f"Chunk #{row}\n")
+            parts.append(f"Chunk ID: {chunk_id}\n")
+            parts.append(f"Title: {self.titles[row]}\n")
+            parts.append(f"Summary: {self.summaries[row]}\n")
+            parts.append("Propositions:\n")
+            for prop in self.propositions[row]:
+                parts.append(f"  - {prop}\n")
+            parts.append("\n\n")
+        sys.stdout.write("".join(parts))
 
     def pretty_print_chunk_outline(self):
-        print("Chunk Outline\n")
-        print(self.get_chunk_outline())
+        self.flush()
+        sys.stdout.write(f"Chunk Outline\n\n{self.get_chunk_outline()}\n")
 
 
 if __name__ == "__main__":